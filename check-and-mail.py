@@ -1,10 +1,16 @@
 import os
 import csv
 import json
-from ebird.api import get_nearby_observations
+import functools
+import heapq
+from collections import Counter
+from operator import itemgetter
 from dotenv import load_dotenv
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Load environment variables
 load_dotenv()
@@ -25,11 +31,14 @@ if RECIPIENTS_EMAIL is None:
     # throw an error if the recipient email is not set
     raise ValueError("RECIPIENTS_EMAIL environment variable not set.")
 
-# make sure it can be split by commas
-if "," in RECIPIENTS_EMAIL:
-    RECIPIENTS_EMAIL = RECIPIENTS_EMAIL.split(",")
-else:
-    RECIPIENTS_EMAIL = [RECIPIENTS_EMAIL]
+# split by commas, dropping surrounding whitespace and empty entries
+RECIPIENTS_EMAIL = [
+    email.strip() for email in RECIPIENTS_EMAIL.split(",") if email.strip()
+]
+
+if not RECIPIENTS_EMAIL:
+    # throw an error if there are no recipients left after splitting
+    raise ValueError("RECIPIENTS_EMAIL environment variable not set.")
 
 
 print(RECIPIENTS_EMAIL)
@@ -47,24 +56,66 @@ LIFE_LIST_PATH = "./my_bird_lists/life_list.csv"
 # Email settings
 EMAIL_SUBJECT = "Birds to Add to Your Life List"
 MAX_BIRDS_TO_SHOW = 10
+BIRD_ROW_TEMPLATE = """
+        <tr>
+            <td style="padding: 16px; border-bottom: 1px solid #eee;">
+                <h3 style="margin: 0 0 8px 0; color: #2c3e50;">{common_name}</h3>
+                <p style="margin: 0 0 8px 0; font-style: italic; color: #7f8c8d;">{scientific_name}</p>
+                <p style="margin: 0 0 8px 0;"><strong>Location:</strong> {location}</p>
+                <p style="margin: 0 0 8px 0;"><strong>Last seen:</strong> {date}</p>
+                <p style="margin: 0 0 12px 0;"><strong>Count:</strong> {count}</p>
+                <a href="https://ebird.org/hotspot/{loc_id}" 
+                   style="display: inline-block; padding: 8px 16px; 
+                          background-color: #27ae60; color: white; 
+                          text-decoration: none; border-radius: 4px;
+                          font-weight: 600;">
+                    View on eBird
+                </a>
+            </td>
+        </tr>
+        """
 
-
-def read_csv_file(file_path):
-    """Read a CSV file and return data as a list of dictionaries"""
-    data = []
+# HTTP settings: (connect, read) timeouts in seconds; the LLM can take a
+# while to reason before it responds
+REQUEST_TIMEOUT = (5, 20)
+LLM_REQUEST_TIMEOUT = (5, 120)
+
+# Shared HTTP session so keep-alive connections are reused across requests,
+# retrying transient failures with exponential back-off
+SESSION = requests.Session()
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            raise_on_status=False,
+        ),
+        pool_connections=10,
+        pool_maxsize=10,
+    ),
+)
+
+
+def read_life_list(file_path):
+    """Read a life list CSV file and return its scientific names as a frozenset"""
     try:
         with open(file_path, "r", newline="", encoding="utf-8") as csvfile:
-            reader = csv.DictReader(csvfile)
-            for row in reader:
-                data.append(row)
-        return data
+            reader = csv.reader(csvfile)
+            header = next(reader, None)
+            if header is None:
+                raise ValueError("life list file is empty")
+            name_index = header.index("Scientific Name")
+            # skip blank lines and short rows, as csv.DictReader would
+            return frozenset(
+                row[name_index] for row in reader if len(row) > name_index
+            )
     except Exception as e:
         raise Exception(f"Error reading CSV file: {e}")
 
 
 def main():
-    # Load environment variables as fallback
-    load_dotenv()
     ebird_key = os.environ.get("EBIRD_API_KEY", EBIRD_API_KEY)
     sendinblue_key = os.environ.get("SENDINBLUE_API_KEY", SENDINBLUE_API_KEY)
 
@@ -74,39 +125,60 @@ def main():
         )
         return
 
-    # Read life list from CSV file
-    try:
-        life_list = read_csv_file(LIFE_LIST_PATH)
-        print(f"Successfully loaded life list with {len(life_list)} species.")
-    except FileNotFoundError:
+    # Check the life list is there before starting the eBird request
+    if not os.path.exists(LIFE_LIST_PATH):
         print(f"Error: Life list file not found at {LIFE_LIST_PATH}")
         return
-    except Exception as e:
-        print(f"Error reading life list: {e}")
-        return
 
-    # Extract the scientific names from life list for easier comparison
-    life_list_species = set(item.get("Scientific Name", "") for item in life_list)
-    # Get local observations
-    try:
-        print(
-            f"Getting birds within {SEARCH_DISTANCE_KM}km of your location for the past {DAYS_BACK} days..."
-        )
-        records = get_nearby_observations(
-            ebird_key, LATITUDE, LONGITUDE, dist=SEARCH_DISTANCE_KM, back=DAYS_BACK
+    from ebird.api import get_nearby_observations
+
+    # Read the life list while local observations are fetched, since the two
+    # don't depend on each other. Leaving the block waits for both, so if the
+    # life list can't be read the error prints right away but main only
+    # returns once the eBird request has finished
+    print(
+        f"Getting birds within {SEARCH_DISTANCE_KM}km of your location for the past {DAYS_BACK} days..."
+    )
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        life_list_future = executor.submit(read_life_list, LIFE_LIST_PATH)
+        records_future = executor.submit(
+            get_nearby_observations,
+            ebird_key,
+            LATITUDE,
+            LONGITUDE,
+            dist=SEARCH_DISTANCE_KM,
+            back=DAYS_BACK,
         )
-        print(f"Found {len(records)} recent observations nearby.")
-    except Exception as e:
-        print(f"Error fetching eBird observations: {e}")
-        return
+
+        # Read life list from CSV file
+        try:
+            life_list_species = life_list_future.result()
+            print(
+                f"Successfully loaded life list with {len(life_list_species)} species."
+            )
+        except Exception as e:
+            print(f"Error reading life list: {e}")
+            return
+
+        # Get local observations
+        try:
+            records = records_future.result()
+            print(f"Found {len(records)} recent observations nearby.")
+        except Exception as e:
+            print(f"Error fetching eBird observations: {e}")
+            return
 
     import sys
 
-    # Find birds that aren't on your life list
+    # Find birds that aren't on your life list, keeping one entry per
+    # species per location
     new_birds = []
+    seen = set()
     for record in records:
         sci_name = record.get("sciName")
-        if sci_name and sci_name not in life_list_species:
+        key = (sci_name, record.get("locId"))
+        if sci_name and sci_name not in life_list_species and key not in seen:
+            seen.add(key)
             new_birds.append(
                 {
                     "common_name": record.get("comName", "Unknown"),
@@ -118,25 +190,26 @@ def main():
                 }
             )
 
-    # Sort by rarity (fewer observations means potentially more valuable)
-    species_counts = {}
-    for bird in new_birds:
-        species = bird["scientific_name"]
-        species_counts[species] = species_counts.get(species, 0) + 1
+    # Count by rarity (fewer observations means potentially more valuable),
+    # over all observations so duplicates still count
+    species_counts = Counter(record.get("sciName") for record in records)
 
-    # Sort the birds by count (ascending) and then by name
-    sorted_birds = sorted(
-        new_birds,
-        key=lambda x: (species_counts[x["scientific_name"]], x["common_name"]),
-    )
+    for bird in new_birds:
+        bird["rarity"] = species_counts[bird["scientific_name"]]
 
-    # print(sorted_birds)
+    # Order the birds by count (ascending) and then by name. The LLM prompt
+    # lists every bird, so sort them all; otherwise only pick out the few
+    # shown in the email
+    rarity_order = itemgetter("rarity", "common_name")
+    content = None
     if LLM_API_KEY is not None:
-        text_rep = ""
-        for bird in sorted_birds:
-            text_rep += (
-                f"{bird['common_name']} ({bird['scientific_name']}) x {bird['count']}\n"
-            )
+        sorted_birds = sorted(new_birds, key=rarity_order)
+        top_birds = sorted_birds[:MAX_BIRDS_TO_SHOW]
+
+        text_rep = "".join(
+            f"{bird['common_name']} ({bird['scientific_name']}) x {bird['count']}\n"
+            for bird in sorted_birds
+        )
         print(text_rep)
 
         prompt = (
@@ -156,22 +229,28 @@ def main():
                 "content": f"{prompt} {text_rep}",
             },
         ]
-        response = requests.post(
-            "https://api.openai.com/v1/chat/completions",
-            headers={
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {LLM_API_KEY}",
-            },
-            data=json.dumps(
-                {
-                    "model": "o4-mini",
-                    "messages": conversation,
-                    "response_format": {"type": "text"},
-                    "reasoning_effort": "medium",
-                    "store": False,
-                }
-            ),
-        )
+        try:
+            response = SESSION.post(
+                "https://api.openai.com/v1/chat/completions",
+                headers={
+                    "Content-Type": "application/json",
+                    "Authorization": f"Bearer {LLM_API_KEY}",
+                },
+                data=json.dumps(
+                    {
+                        "model": "o4-mini",
+                        "messages": conversation,
+                        "response_format": {"type": "text"},
+                        "reasoning_effort": "medium",
+                        "store": False,
+                    }
+                ),
+                timeout=LLM_REQUEST_TIMEOUT,
+            )
+        except Exception as e:
+            print(f"Error requesting LLM summary: {e}")
+            return
+
         if response.status_code != 200:
             print(f"Error: {response.status_code} - {response.text}")
             return
@@ -181,53 +260,40 @@ def main():
         content = response_data["choices"][0]["message"]["content"]
         print(content)
         print()
+    else:
+        top_birds = heapq.nsmallest(MAX_BIRDS_TO_SHOW, new_birds, key=rarity_order)
 
     # Create email content
-    email_content = create_email_content(
-        sorted_birds[:MAX_BIRDS_TO_SHOW], llm_content=content
-    )
+    email_content = create_email_content(top_birds, llm_content=content)
 
-    # Send email
-    for recipient in RECIPIENTS_EMAIL:
-        print(f"Sending email to {recipient}...")
-        send_email(sendinblue_key, recipient, EMAIL_SUBJECT, email_content)
+    # Send one email to all recipients
+    print(f"Sending email to {', '.join(RECIPIENTS_EMAIL)}...")
+    send_email(sendinblue_key, RECIPIENTS_EMAIL, EMAIL_SUBJECT, email_content)
 
     print("Email sent with your birding opportunities!")
 
 
+@functools.lru_cache(maxsize=None)
+def format_observation_date(observation_date):
+    """Format an eBird observation date more nicely if possible"""
+    try:
+        date_obj = datetime.strptime(observation_date, "%Y-%m-%d %H:%M")
+        return date_obj.strftime("%b %d, %Y at %I:%M %p")
+    except ValueError:
+        return observation_date
+
+
 def create_email_content(birds, llm_content=None):
     """Create HTML email content from the list of birds"""
 
     today_date = datetime.now().strftime("%B %d, %Y")
 
-    bird_html = ""
-    for i, bird in enumerate(birds, 1):
-        observation_date = bird["date"]
-        try:
-            # Try to format the date more nicely if possible
-            date_obj = datetime.strptime(observation_date, "%Y-%m-%d %H:%M")
-            observation_date = date_obj.strftime("%b %d, %Y at %I:%M %p")
-        except:
-            pass
-
-        bird_html += f"""
-        <tr>
-            <td style="padding: 16px; border-bottom: 1px solid #eee;">
-                <h3 style="margin: 0 0 8px 0; color: #2c3e50;">{bird['common_name']}</h3>
-                <p style="margin: 0 0 8px 0; font-style: italic; color: #7f8c8d;">{bird['scientific_name']}</p>
-                <p style="margin: 0 0 8px 0;"><strong>Location:</strong> {bird['location']}</p>
-                <p style="margin: 0 0 8px 0;"><strong>Last seen:</strong> {observation_date}</p>
-                <p style="margin: 0 0 12px 0;"><strong>Count:</strong> {bird['count']}</p>
-                <a href="https://ebird.org/hotspot/{bird['loc_id']}" 
-                   style="display: inline-block; padding: 8px 16px; 
-                          background-color: #27ae60; color: white; 
-                          text-decoration: none; border-radius: 4px;
-                          font-weight: 600;">
-                    View on eBird
-                </a>
-            </td>
-        </tr>
-        """
+    bird_html = "".join(
+        BIRD_ROW_TEMPLATE.format_map(
+            {**bird, "date": format_observation_date(bird["date"])}
+        )
+        for bird in birds
+    )
 
     # No birds message
     if not bird_html:
@@ -258,7 +324,7 @@ def create_email_content(birds, llm_content=None):
             <p style="margin-top: 0;">Here are the top birds in your area that aren't on your life list yet:</p>
             
             <p style="margin: 0 0 20px 0; font-size: 14px; color: #7f8c8d;">
-                {llm_content}
+                {llm_content or ""}
             </p>
 
             <table style="width: 100%; border-collapse: collapse; margin: 20px 0;">
@@ -277,16 +343,17 @@ def create_email_content(birds, llm_content=None):
     """
 
 
-def send_email(api_key, recipientS_email, subject, html_content):
-    """Send email using SendInBlue API"""
+def send_email(api_key, recipients, subject, html_content):
+    """Send email to all recipients in a single SendInBlue API call"""
 
     url = "https://api.sendinblue.com/v3/smtp/email"
 
     payload = {
         "sender": {"name": SENDER_NAME, "email": SENDER_EMAIL},
-        "to": [{"email": recipientS_email}],
         "subject": subject,
         "htmlContent": html_content,
+        # one version per recipient so they don't see each other's address
+        "messageVersions": [{"to": [{"email": email}]} for email in recipients],
     }
 
     headers = {
@@ -296,12 +363,14 @@ def send_email(api_key, recipientS_email, subject, html_content):
     }
 
     try:
-        response = requests.post(url, json=payload, headers=headers)
+        response = SESSION.post(
+            url, json=payload, headers=headers, timeout=REQUEST_TIMEOUT
+        )
         response_data = response.json()
 
         if response.status_code == 201:
             print("Email sent successfully!")
-            print(f"Message ID: {response_data.get('messageId')}")
+            print(f"Message IDs: {response_data.get('messageIds')}")
         else:
             print(f"Failed to send email. Status code: {response.status_code}")
             print(f"Error: {response_data}")
@@ -1,11 +1,14 @@
 import os
 import sys
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from pathlib import Path
 import re
+from html.parser import HTMLParser
 import getpass
 import argparse
-from bs4 import BeautifulSoup
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -16,34 +19,82 @@ PASSWORD = os.getenv("EBIRD_PASSWORD")
 if USERNAME is None or PASSWORD is None:
     raise ValueError("EBIRD_USERNAME or EBIRD_PASSWORD environment variable not set.")
 
+# (connect, read) timeouts in seconds for every request
+REQUEST_TIMEOUT = (5, 20)
+
+
+def create_session():
+    """
+    Creates a session that retries transient failures with exponential back-off.
+    """
+    retries = Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504], raise_on_status=False)
+    session = requests.Session()
+    session.mount('https://', HTTPAdapter(max_retries=retries, pool_connections=10, pool_maxsize=10))
+    return session
+
+
+def clone_session(session):
+    """
+    Creates a new retrying session carrying the cookies of an existing one.
+    """
+    clone = create_session()
+    clone.cookies.update(session.cookies)
+    return clone
+
+
+class InputValueParser(HTMLParser):
+    """
+    Collects the value of each named <input> field in an HTML page.
+    """
+    def __init__(self):
+        super().__init__()
+        self.values = {}
+
+    def handle_starttag(self, tag, attrs):
+        if tag != 'input':
+            return
+        attrs = dict(attrs)
+        name = attrs.get('name')
+        # Keep the first field with a given name
+        if name is not None and name not in self.values:
+            self.values[name] = attrs.get('value') or ''
+
+
+def find_input_values(page):
+    """
+    Returns a dict mapping <input> field names to their values in an HTML page.
+    """
+    parser = InputValueParser()
+    parser.feed(page)
+    parser.close()
+    return parser.values
+
+
 def get_ebird_session(username, password):
     """
-    Logs into eBird and returns the session ID.
+    Logs into eBird and returns the authenticated session.
     """
     login_url = "https://secure.birds.cornell.edu/cassso/login"
     
     # Initial request to get the form data
-    session = requests.Session()
-    response = session.get(login_url)
+    session = create_session()
+    response = session.get(login_url, timeout=REQUEST_TIMEOUT)
     
     if response.status_code != 200:
         print(f"Failed to access login page. Status code: {response.status_code}")
         return None
     
     # Parse the HTML to extract form data
-    soup = BeautifulSoup(response.text, 'html.parser')
+    input_values = find_input_values(response.text)
     
     # Find the execution value
-    execution_input = soup.find('input', {'name': 'execution'})
-    if not execution_input:
+    execution_value = input_values.get('execution')
+    if execution_value is None:
         print("Could not find execution value in the login form.")
         return None
     
-    execution_value = execution_input.get('value', '')
-    
     # Find the _eventId value
-    event_id_input = soup.find('input', {'name': '_eventId'})
-    event_id_value = event_id_input.get('value', 'submit') if event_id_input else 'submit'
+    event_id_value = input_values.get('_eventId') or 'submit'
     
     # Prepare login data
     login_data = {
@@ -55,24 +106,27 @@ def get_ebird_session(username, password):
     }
     
     # Perform login
-    response = session.post(login_url, data=login_data, allow_redirects=True)
+    response = session.post(login_url, data=login_data, allow_redirects=True, timeout=REQUEST_TIMEOUT)
     
-    # Check if login was successful
-    ebird_home = "https://ebird.org/home"
-    response = session.get(ebird_home)
+    # The login redirect chain normally sets the session cookie already;
+    # only visit the eBird home page if it didn't
+    cookies = session.cookies.get_dict()
+    if 'EBIRD_SESSIONID' not in cookies:
+        ebird_home = "https://ebird.org/home"
+        response = session.get(ebird_home, timeout=REQUEST_TIMEOUT)
+        cookies = session.cookies.get_dict()
     
     # Check for session cookie
-    cookies = session.cookies.get_dict()
     if 'EBIRD_SESSIONID' in cookies:
-        return cookies['EBIRD_SESSIONID']
+        return session
     else:
         print("Login failed. Please check your credentials.")
         return None
 
 
-def download_csv(session_id, download_url, output_file):
+def download_csv(session, download_url, output_file):
     """
-    Downloads a CSV file from eBird using the provided session ID.
+    Downloads a CSV file from eBird using the provided authenticated session.
     """
     headers = {
         "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
@@ -80,29 +134,30 @@ def download_csv(session_id, download_url, output_file):
         "Accept-Language": "en-US,en;q=0.5"
     }
 
-    session = requests.Session()
-    response = session.get(download_url, cookies={'EBIRD_SESSIONID': session_id}, headers=headers)
+    with session.get(download_url, headers=headers, stream=True, timeout=REQUEST_TIMEOUT) as response:
+        if response.status_code != 200:
+            print(f"Failed to download file. HTTP Status Code: {response.status_code}")
+            print("Response:", response.text)
+            return False
 
-    if response.status_code == 200:
         output_path = Path(output_file)
 
         if not output_path.parent.exists():
             output_path.parent.mkdir(parents=True, exist_ok=True)
 
+        # Stream the body to disk rather than holding it all in memory
+        with open(output_path, 'wb') as output:
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                output.write(chunk)
+
         # Check if we got CSV content
         if 'text/csv' in response.headers.get('Content-Type', ''):
-            output_path.write_bytes(response.content)
             print(f"Successfully downloaded: {output_file}")
             return True
         else:
+            # Saved anyway, but warn the user
             print(f"Warning: Response doesn't appear to be a CSV file. Content-Type: {response.headers.get('Content-Type')}")
-            # Save anyway, but warn the user
-            output_path.write_bytes(response.content)
             return False
-    else:
-        print(f"Failed to download file. HTTP Status Code: {response.status_code}")
-        print("Response:", response.text)
-        return False
 
 
 def parse_arguments():
@@ -128,7 +183,7 @@ def parse_arguments():
 def main():
     args = parse_arguments()
     output_dir = args.output_dir
-    session_id = None
+    session = None
     
     # Set default year to current year if not specified
     import datetime
@@ -137,30 +192,39 @@ def main():
     # Handle authentication
     if args.session_id:
         # Directly use provided session ID
-        session_id = args.session_id
+        session = create_session()
+        session.cookies.set('EBIRD_SESSIONID', args.session_id)
     
     elif args.login:
-        # Get session ID by logging in
-        session_id = get_ebird_session(USERNAME, PASSWORD)
-        if not session_id:
+        # Get an authenticated session by logging in
+        session = get_ebird_session(USERNAME, PASSWORD)
+        if session is None:
             sys.exit(1)
+        session_id = session.cookies.get_dict()['EBIRD_SESSIONID']
         print(f"Successfully logged in. Your session ID is: {session_id}")
     
-    # Download the requested lists
-    success = True
+    # Collect the requested lists
+    downloads = []
     
     if 'life' in args.lists:
-        success &= download_csv(session_id, 'https://ebird.org/lifelist?r=world&time=life&fmt=csv', 
-                            os.path.join(output_dir, "life_list.csv"))
+        downloads.append(('https://ebird.org/lifelist?r=world&time=life&fmt=csv', 
+                          os.path.join(output_dir, "life_list.csv")))
     
     if 'year' in args.lists:
-        success &= download_csv(session_id, f'https://ebird.org/lifelist?r=world&time=year&year={current_year}&fmt=csv', 
-                            os.path.join(output_dir, f"year_list_{current_year}.csv"))
+        downloads.append((f'https://ebird.org/lifelist?r=world&time=year&year={current_year}&fmt=csv', 
+                          os.path.join(output_dir, f"year_list_{current_year}.csv")))
     
     if 'month' in args.lists:
         current_month = datetime.datetime.now().month
-        success &= download_csv(session_id, f'https://ebird.org/lifelist?r=world&time=month&month={current_month}&fmt=csv', 
-                            os.path.join(output_dir, f"month_list_{current_month}_{current_year}.csv"))
+        downloads.append((f'https://ebird.org/lifelist?r=world&time=month&month={current_month}&fmt=csv', 
+                          os.path.join(output_dir, f"month_list_{current_month}_{current_year}.csv")))
+    
+    # Download the requested lists concurrently, each on its own copy of the
+    # authenticated session since requests.Session isn't documented as thread-safe
+    with ThreadPoolExecutor(max_workers=max(len(downloads), 1)) as executor:
+        futures = [executor.submit(download_csv, clone_session(session), url, output_file)
+                   for url, output_file in downloads]
+        success = all([future.result() for future in futures])
     
     if success:
         print("All downloads completed successfully.")